@@ -1,15 +1,15 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file
 import os
 import sys
-import glob
 import logging
+import threading
 
 # Add the src directory to the path so we can import the modules
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
-from src.chromedriver import setup_driver, capture_with_retry
-from src.paths import get_screenshot_path, assets_dir
-from src.url_utils import format_url_to_filename
+from src.chromedriver import setup_driver, capture_with_retry, resolve_viewports
+from src.paths import get_screenshot_path, get_capture_key, assets_dir, asset_store
+from src.url_utils import url_key
 
 # Configure logging
 logging.basicConfig(
@@ -20,6 +20,85 @@ logger = logging.getLogger('app')
 
 app = Flask(__name__)
 
+# Captures in progress, keyed by capture key, so duplicate submissions share one capture
+_inflight_captures = {}
+_inflight_lock = threading.Lock()
+
+def capture_deduplicated(url, viewports=None, ttl=None):
+    """
+    Captures screenshots for a URL, joining any in-progress capture of the same
+    canonical URL and viewports instead of launching a second browser.
+    The capture is recorded once, by the request that ran it, with its ttl.
+    Returns a list of (capture key, screenshot paths), one per viewport.
+    A capture that would write tiles of an in-progress capture with different
+    settings (the same viewport name at another size) waits for it to finish;
+    captures writing disjoint tiles run concurrently.
+    """
+    if viewports:
+        capture_keys = tuple(get_capture_key(url, viewport['name']) for viewport in viewports)
+    else:
+        capture_keys = (get_capture_key(url),)
+    # Same-named viewports may differ in size, so match on every setting
+    signature = tuple(
+        (viewport['name'], viewport['width'], viewport['height'],
+         viewport['device_scale_factor'], viewport['mobile'], viewport['user_agent'])
+        for viewport in viewports or []
+    )
+    while True:
+        with _inflight_lock:
+            busy = [_inflight_captures[key] for key in capture_keys if key in _inflight_captures]
+            if not busy:
+                entry = {'keys': capture_keys, 'signature': signature,
+                         'done': threading.Event(), 'result': None, 'error': None}
+                for key in capture_keys:
+                    _inflight_captures[key] = entry
+                break
+            entry = busy[0]
+        
+        entry['done'].wait()
+        if entry['keys'] != capture_keys or entry['signature'] != signature:
+            logger.info(f"Waited for an overlapping capture of URL {url} at other viewports")
+            continue
+        logger.info(f"Joined in-progress capture for URL: {url} (key: {url_key(url)})")
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+    
+    # Keep the janitor away from these captures while their tiles are written
+    asset_store.reserve(capture_keys)
+    try:
+        result = capture_with_retry(url, viewports=viewports)
+        if viewports:
+            captures = [(capture_key, result[viewport['name']])
+                        for capture_key, viewport in zip(capture_keys, viewports)]
+        else:
+            captures = [(capture_keys[0], result)]
+        
+        # Register each capture with the storage layer (size cap and TTL)
+        for capture_key, screenshot_files in captures:
+            asset_store.record_capture(capture_key, screenshot_files, ttl=ttl)
+        entry['result'] = captures
+        return captures
+    except Exception as e:
+        entry['error'] = e
+        raise
+    finally:
+        asset_store.release(capture_keys)
+        with _inflight_lock:
+            for key in capture_keys:
+                _inflight_captures.pop(key, None)
+        entry['done'].set()
+
+@app.before_request
+def start_asset_janitor():
+    """
+    Starts the storage janitor (expire, pack, evict) in the process that
+    actually serves requests, whether that is the reloader's child under
+    `python app.py`, `flask run` or a WSGI worker. The reloader's watcher
+    process never serves a request, so it never runs one.
+    """
+    asset_store.start_janitor()
+
 @app.route('/', methods=['GET'])
 def index():
     """Root endpoint, returns server status"""
@@ -27,10 +106,10 @@ def index():
         'status': 'online',
         'service': 'ChromeDriving',
         'endpoints': {
-            '/submit-url': 'POST - Submit a URL for screenshot capture',
+            '/submit-url': 'POST - Submit a URL for screenshot capture (optionally at several viewports)',
             '/screenshots': 'GET - List all available screenshots',
             '/screenshots/<filename>': 'GET - Retrieve a specific screenshot by filename',
-            '/screenshots/by-url': 'GET - Retrieve screenshots for a specific URL (with url parameter)'
+            '/screenshots/by-url': 'GET - Retrieve screenshots for a specific URL (with url and optional viewport parameters)'
         }
     })
 
@@ -42,28 +121,62 @@ def submit_url():
         return jsonify({'error': 'URL is required'}), 400
     
     url = data['url']
+    if not isinstance(url, str) or not url.strip():
+        logger.warning(f"Invalid URL parameter: {url}")
+        return jsonify({'error': 'Invalid URL: URL must be a non-empty string'}), 400
+    ttl = data.get('ttl')
+    if ttl is not None and (isinstance(ttl, bool) or not isinstance(ttl, int) or ttl <= 0):
+        logger.warning(f"Invalid ttl parameter: {ttl}")
+        return jsonify({'error': 'ttl must be a positive integer (seconds)'}), 400
+    
+    viewports = data.get('viewports')
+    if viewports is not None:
+        try:
+            viewports = resolve_viewports(viewports)
+        except ValueError as e:
+            logger.warning(f"Invalid viewports parameter: {str(e)}")
+            return jsonify({'error': f'Invalid viewports: {str(e)}'}), 400
     logger.info(f"Processing screenshot request for URL: {url}")
     
     try:
-        # Capture screenshots with retry mechanism
-        screenshot_files = capture_with_retry(url)
+        # Capture screenshots with retry mechanism, sharing duplicate in-flight requests
+        captures = capture_deduplicated(url, viewports, ttl)
         
         # Prepare response with relative paths
-        screenshots = []
-        for file_path in screenshot_files:
-            filename = os.path.basename(file_path)
-            screenshots.append({
-                'filename': filename,
-                'path': f'/screenshots/{filename}'
-            })
+        groups = []
+        for _, screenshot_files in captures:
+            screenshots = []
+            for file_path in screenshot_files:
+                filename = os.path.basename(file_path)
+                screenshots.append({
+                    'filename': filename,
+                    'path': f'/screenshots/{filename}'
+                })
+            groups.append(screenshots)
+        screenshots = [screenshot for group in groups for screenshot in group]
         
-        logger.info(f"Successfully captured {len(screenshots)} screenshots for URL: {url}")
-        return jsonify({
+        response = {
             'success': True, 
             'message': f'Captured {len(screenshots)} screenshots for URL: {url}',
             'url': url,
             'screenshots': screenshots
-        })
+        }
+        if viewports:
+            # Group the results per viewport
+            response['viewports'] = [
+                {
+                    'name': viewport['name'],
+                    'width': viewport['width'],
+                    'height': viewport['height'],
+                    'mobile': viewport['mobile'],
+                    'total': len(group),
+                    'screenshots': group
+                }
+                for viewport, group in zip(viewports, groups)
+            ]
+        
+        logger.info(f"Successfully captured {len(screenshots)} screenshots for URL: {url}")
+        return jsonify(response)
     except ValueError as e:
         # Handle URL validation errors
         logger.error(f"URL validation error: {str(e)}")
@@ -81,13 +194,12 @@ def submit_url():
 def list_screenshots():
     """List all available screenshots"""
     try:
-        # Get all PNG files in the assets directory
-        screenshot_files = glob.glob(os.path.join(assets_dir, "*.png"))
+        # Get all stored screenshots, loose and packed
+        screenshot_files = asset_store.list_assets()
         
         # Format the response with filenames
         screenshots = []
-        for file in screenshot_files:
-            filename = os.path.basename(file)
+        for filename in screenshot_files:
             screenshots.append({
                 'filename': filename,
                 'path': f'/screenshots/{filename}'
@@ -112,13 +224,13 @@ def get_screenshot(filename):
             logger.warning(f"Invalid filename requested: {filename}")
             return jsonify({'error': 'Invalid filename'}), 400
             
-        file_path = os.path.join(assets_dir, filename)
-        if not os.path.exists(file_path):
+        screenshot = asset_store.open_asset(filename)
+        if screenshot is None:
             logger.warning(f"Screenshot not found: {filename}")
             return jsonify({'error': 'Screenshot not found'}), 404
             
         logger.info(f"Serving screenshot: {filename}")
-        return send_from_directory(assets_dir, filename)
+        return send_file(screenshot, mimetype='image/png', download_name=filename)
     except Exception as e:
         logger.error(f"Error retrieving screenshot {filename}: {str(e)}")
         return jsonify({'error': f'Error retrieving screenshot: {str(e)}'}), 500
@@ -130,21 +242,14 @@ def get_screenshot_by_url():
     if not url:
         logger.warning("Request missing URL parameter")
         return jsonify({'error': 'URL parameter is required'}), 400
+    viewport = request.args.get('viewport')
         
     try:
-        # Get the filename pattern for this URL
-        base_filename = format_url_to_filename(url)
-        logger.info(f"Looking for screenshots for URL: {url} (base filename: {base_filename})")
+        # Tiles of a capture share the capture key of the URL (and viewport, if captured per viewport)
+        capture_key = get_capture_key(url, viewport)
+        logger.info(f"Looking for screenshots for URL: {url} (capture key: {capture_key})")
         
-        # The filename might have an index suffix if multiple screenshots were taken
-        base_path = os.path.join(assets_dir, base_filename.replace('.png', ''))
-        screenshot_files = glob.glob(f"{base_path}_*.png")
-        
-        # If no indexed files are found, try the direct filename
-        if not screenshot_files:
-            direct_path = os.path.join(assets_dir, base_filename)
-            if os.path.exists(direct_path):
-                screenshot_files = [direct_path]
+        screenshot_files = asset_store.find_capture(capture_key)
         
         if not screenshot_files:
             logger.warning(f"No screenshots found for URL: {url}")
@@ -156,8 +261,7 @@ def get_screenshot_by_url():
             
         # Format the response
         screenshots = []
-        for file in screenshot_files:
-            filename = os.path.basename(file)
+        for filename in screenshot_files:
             screenshots.append({
                 'filename': filename,
                 'path': f'/screenshots/{filename}'
@@ -3,7 +3,7 @@ import sys
 import time
 import logging
 import platform
-from urllib.parse import urlparse
+import re
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
@@ -19,8 +19,8 @@ from selenium.common.exceptions import (
 )
 from webdriver_manager.chrome import ChromeDriverManager
 
-from src.paths import assets_dir, get_screenshot_path
-from src.url_utils import format_url_to_filename
+from src.paths import assets_dir, get_tile_path
+from src.url_utils import format_url_to_filename, validate_url
 
 # Configure logging
 logging.basicConfig(
@@ -37,25 +37,23 @@ SCROLL_HEIGHT = 1080
 WAIT_TIME_COOKIE = 3
 WAIT_TIME_CSS = 1
 SCROLL_PAUSE_TIME = 0.5
+MOBILE_USER_AGENT = ('Mozilla/5.0 (Linux; Android 13; Pixel 7) AppleWebKit/537.36 '
+                     '(KHTML, like Gecko) Chrome/114.0.0.0 Mobile Safari/537.36')
+TABLET_USER_AGENT = ('Mozilla/5.0 (Linux; Android 13; Pixel Tablet) AppleWebKit/537.36 '
+                     '(KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36')
+MAX_TOUCH_POINTS = 5
 
-def validate_url(url):
-    """
-    Validates if the URL is properly formatted and includes a scheme.
-    Returns the validated URL or raises ValueError.
-    """
-    try:
-        parsed = urlparse(url)
-        if not parsed.scheme:
-            # Add http:// if no scheme is provided
-            url = f"http://{url}"
-            parsed = urlparse(url)
-        
-        if not parsed.netloc:
-            raise ValueError(f"Invalid URL: {url}")
-            
-        return url
-    except Exception as e:
-        raise ValueError(f"URL validation error: {str(e)}")
+# Device profiles selectable by name when capturing multiple viewports
+VIEWPORT_PROFILES = {
+    'desktop': {'width': 1920, 'height': SCROLL_HEIGHT, 'device_scale_factor': 1, 'mobile': False, 'user_agent': None},
+    'laptop': {'width': 1366, 'height': 768, 'device_scale_factor': 1, 'mobile': False, 'user_agent': None},
+    'tablet': {'width': 768, 'height': 1024, 'device_scale_factor': 1, 'mobile': True, 'user_agent': TABLET_USER_AGENT},
+    'mobile': {'width': 390, 'height': 844, 'device_scale_factor': 1, 'mobile': True, 'user_agent': MOBILE_USER_AGENT}
+}
+MAX_USER_AGENT_LENGTH = 512
+MAX_VIEWPORTS = 8
+MAX_VIEWPORT_DIMENSION = 4096
+VIEWPORT_NAME_PATTERN = re.compile(r'^[a-zA-Z][a-zA-Z0-9-]{0,31}$')
 
 def setup_driver():
     """
@@ -268,70 +266,194 @@ def take_screenshot(driver, path, scroll_position=0):
         logger.error(f"Failed to take screenshot at position {scroll_position}: {str(e)}")
         return False
 
-def get_url_screenshot(driver, url, retry_count=0):
+def resolve_viewports(viewports):
+    """
+    Resolves a list of viewport requests into full viewport definitions.
+    Each entry is either a profile name from VIEWPORT_PROFILES or a dict with
+    a name, width and height (and optionally device_scale_factor, mobile and
+    user_agent), where a dict naming a known profile overrides that profile's
+    values. Mobile viewports without a user agent get MOBILE_USER_AGENT.
+    Returns the list of viewports or raises ValueError.
+    """
+    if not isinstance(viewports, list) or not viewports:
+        raise ValueError("viewports must be a non-empty list")
+    if len(viewports) > MAX_VIEWPORTS:
+        raise ValueError(f"At most {MAX_VIEWPORTS} viewports can be captured per request")
+
+    resolved = []
+    for entry in viewports:
+        if isinstance(entry, str):
+            entry = {'name': entry}
+        if not isinstance(entry, dict):
+            raise ValueError(f"Invalid viewport: {entry}")
+
+        name = entry.get('name')
+        if not isinstance(name, str) or not VIEWPORT_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid viewport name: {name}")
+        viewport = dict(VIEWPORT_PROFILES.get(name, {'device_scale_factor': 1, 'mobile': False, 'user_agent': None}))
+        viewport.update((field, entry[field])
+                        for field in ('width', 'height', 'device_scale_factor', 'mobile', 'user_agent') if field in entry)
+        viewport['name'] = name
+
+        for dimension in ('width', 'height'):
+            value = viewport.get(dimension)
+            if isinstance(value, bool) or not isinstance(value, int) or not 0 < value <= MAX_VIEWPORT_DIMENSION:
+                raise ValueError(f"Viewport {name} needs a {dimension} between 1 and {MAX_VIEWPORT_DIMENSION}")
+        scale = viewport['device_scale_factor']
+        if isinstance(scale, bool) or not isinstance(scale, (int, float)) or not 0 < scale <= 4:
+            raise ValueError(f"Viewport {name} needs a device_scale_factor between 0 and 4")
+        if not isinstance(viewport['mobile'], bool):
+            raise ValueError(f"Viewport {name} needs a boolean mobile flag")
+        user_agent = viewport['user_agent']
+        if user_agent is not None and (not isinstance(user_agent, str) or not 0 < len(user_agent) <= MAX_USER_AGENT_LENGTH):
+            raise ValueError(f"Viewport {name} needs a user_agent of at most {MAX_USER_AGENT_LENGTH} characters")
+        if viewport['mobile'] and user_agent is None:
+            viewport['user_agent'] = MOBILE_USER_AGENT
+
+        if any(existing['name'] == name for existing in resolved):
+            raise ValueError(f"Duplicate viewport name: {name}")
+        resolved.append(viewport)
+
+    return resolved
+
+def get_default_user_agent(driver):
+    """
+    Returns the browser's own user agent, used to undo user agent overrides.
+    """
+    return driver.execute_cdp_cmd('Browser.getVersion', {})['userAgent']
+
+def set_viewport(driver, viewport):
+    """
+    Emulates the given viewport via CDP device metrics, user agent and touch
+    overrides, keeping the browser, session and HTTP cache instead of
+    relaunching. The overrides apply to the next navigation.
+    """
+    driver.execute_cdp_cmd('Emulation.setDeviceMetricsOverride', {
+        'width': viewport['width'],
+        'height': viewport['height'],
+        'deviceScaleFactor': viewport['device_scale_factor'],
+        'mobile': viewport['mobile']
+    })
+    driver.execute_cdp_cmd('Emulation.setUserAgentOverride', {
+        'userAgent': viewport['user_agent'] or get_default_user_agent(driver)
+    })
+    touch = {'enabled': viewport['mobile']}
+    if viewport['mobile']:
+        touch['maxTouchPoints'] = MAX_TOUCH_POINTS
+    driver.execute_cdp_cmd('Emulation.setTouchEmulationEnabled', touch)
+    logger.info(f"Emulating viewport {viewport['name']} ({viewport['width']}x{viewport['height']}, "
+                f"{'mobile' if viewport['mobile'] else 'desktop'})")
+
+def clear_viewport(driver):
+    """
+    Removes any viewport emulation so the driver can be reused as is.
+    """
+    try:
+        driver.execute_cdp_cmd('Emulation.clearDeviceMetricsOverride', {})
+        driver.execute_cdp_cmd('Emulation.setTouchEmulationEnabled', {'enabled': False})
+        driver.execute_cdp_cmd('Emulation.setUserAgentOverride', {'userAgent': get_default_user_agent(driver)})
+    except Exception as e:
+        # Best effort, the driver may already have been quit after an error
+        logger.warning(f"Failed to clear viewport override: {str(e)}")
+
+def prepare_page(driver):
+    """
+    Readies a freshly loaded page for capture: waits for it to settle,
+    declines cookies and removes hover/focus effects.
+    """
+    # Wait for page to load
+    time.sleep(WAIT_TIME_COOKIE)
+    
+    # Try to decline cookies
+    decline_cookies_if_present(driver)
+    
+    # Wait for cookie banner to disappear
+    time.sleep(WAIT_TIME_CSS)
+    
+    # Remove hover/focus effects by injecting CSS
+    inject_screenshot_css(driver)
+
+def capture_scrolling_screenshots(driver, url, viewport=None):
+    """
+    Scrolls through the loaded page taking one screenshot per viewport height.
+    Returns the list of screenshot paths.
+    """
+    scroll_height = viewport['height'] if viewport else SCROLL_HEIGHT
+    viewport_name = viewport['name'] if viewport else None
+
+    # Get page height
+    total_height = int(driver.execute_script("return document.body.scrollHeight"))
+    logger.info(f"Page height: {total_height}px")
+
+    # Take screenshots
+    screenshot_index = 0
+    current_scroll = 0
+    screenshots = []
+
+    while current_scroll < total_height:
+        # Generate screenshot path
+        screenshot_path = get_tile_path(url, screenshot_index, viewport_name)
+
+        # Take screenshot
+        if take_screenshot(driver, screenshot_path, current_scroll):
+            screenshots.append(screenshot_path)
+            screenshot_index += 1
+
+        # Increment scroll position
+        current_scroll += scroll_height
+
+        # Update total_height in case the page grows
+        try:
+            new_height = int(driver.execute_script("return document.body.scrollHeight"))
+            if new_height > total_height:
+                logger.info(f"Page height increased from {total_height}px to {new_height}px")
+                total_height = new_height
+        except JavascriptException as e:
+            logger.warning(f"Failed to update page height: {str(e)}")
+
+    return screenshots
+
+def get_url_screenshot(driver, url, retry_count=0, viewports=None):
     """
     Captures screenshots of the URL with scrolling.
     Includes retry mechanism and better error handling.
+    When viewports are given the page is loaded at each viewport in turn in
+    the same browser, so later loads are served from its HTTP cache, returning
+    a dict of viewport name to screenshot paths.
     """
     try:
         # Validate and normalize URL
         validated_url = validate_url(url)
         logger.info(f"Getting screenshot for URL: {validated_url}")
         
-        # Navigate to the URL
-        driver.get(validated_url)
-        
-        # Wait for page to load
-        time.sleep(WAIT_TIME_COOKIE)
-        
-        # Try to decline cookies
-        decline_cookies_if_present(driver)
-        
-        # Wait for cookie banner to disappear
-        time.sleep(WAIT_TIME_CSS)
-        
-        # Remove hover/focus effects by injecting CSS
-        inject_screenshot_css(driver)
-        
-        # Get page height
-        total_height = int(driver.execute_script("return document.body.scrollHeight"))
-        logger.info(f"Page height: {total_height}px")
-        
-        # Take screenshots
-        screenshot_index = 0
-        current_scroll = 0
-        screenshots = []
-        
-        while current_scroll < total_height:
-            # Generate screenshot path
-            screenshot_path = get_screenshot_path(url).replace('.png', f'_{screenshot_index}.png')
-            
-            # Take screenshot
-            if take_screenshot(driver, screenshot_path, current_scroll):
-                screenshots.append(screenshot_path)
-                screenshot_index += 1
-            
-            # Increment scroll position
-            current_scroll += SCROLL_HEIGHT
-            
-            # Update total_height in case the page grows
-            try:
-                new_height = int(driver.execute_script("return document.body.scrollHeight"))
-                if new_height > total_height:
-                    logger.info(f"Page height increased from {total_height}px to {new_height}px")
-                    total_height = new_height
-            except JavascriptException as e:
-                logger.warning(f"Failed to update page height: {str(e)}")
+        if not viewports:
+            # Navigate to the URL
+            driver.get(validated_url)
+            prepare_page(driver)
+            screenshots = capture_scrolling_screenshots(driver, url)
+            logger.info(f"Captured {len(screenshots)} screenshots for URL: {url}")
+            return screenshots
         
-        logger.info(f"Captured {len(screenshots)} screenshots for URL: {url}")
-        return screenshots
+        # Load the page fresh at every viewport so load-time layout, srcset and
+        # user agent checks see that device; reloads hit the warm HTTP cache
+        results = {}
+        for index, viewport in enumerate(viewports):
+            set_viewport(driver, viewport)
+            if index == 0:
+                driver.get(validated_url)
+            else:
+                driver.refresh()
+            prepare_page(driver)
+            results[viewport['name']] = capture_scrolling_screenshots(driver, url, viewport)
+            logger.info(f"Captured {len(results[viewport['name']])} screenshots at {viewport['name']} for URL: {url}")
+        return results
         
     except TimeoutException as e:
         logger.warning(f"Page load timeout for URL {url}: {str(e)}")
         if retry_count < MAX_RETRIES:
             logger.info(f"Retrying (attempt {retry_count + 1}/{MAX_RETRIES})...")
             time.sleep(RETRY_DELAY)
-            return get_url_screenshot(driver, url, retry_count + 1)
+            return get_url_screenshot(driver, url, retry_count + 1, viewports)
         else:
             logger.error(f"Max retries exceeded for URL: {url}")
             raise TimeoutException(f"Page load timeout after {MAX_RETRIES} retries: {str(e)}")
@@ -348,7 +470,7 @@ def get_url_screenshot(driver, url, retry_count=0):
             # Restart driver for serious errors
             driver.quit()
             driver = setup_driver()
-            return get_url_screenshot(driver, url, retry_count + 1)
+            return get_url_screenshot(driver, url, retry_count + 1, viewports)
         else:
             logger.error(f"Max retries exceeded for URL: {url}")
             raise WebDriverException(f"WebDriver error after {MAX_RETRIES} retries: {str(e)}")
@@ -358,12 +480,15 @@ def get_url_screenshot(driver, url, retry_count=0):
         raise
         
     finally:
-        # Don't quit the driver here as it might be reused in retry attempts
-        pass
+        # Don't quit the driver here as it might be reused in retry attempts,
+        # but drop any viewport override so retries start from a clean state
+        if viewports:
+            clear_viewport(driver)
 
-def capture_with_retry(url, max_retries=MAX_RETRIES):
+def capture_with_retry(url, max_retries=MAX_RETRIES, viewports=None):
     """
     Wrapper function to set up driver and capture screenshots with retry logic.
+    Pass resolved viewports to capture them all in one browser session.
     """
     driver = None
     retry_count = 0
@@ -373,7 +498,7 @@ def capture_with_retry(url, max_retries=MAX_RETRIES):
             if driver is None:
                 driver = setup_driver()
             
-            screenshots = get_url_screenshot(driver, url, retry_count)
+            screenshots = get_url_screenshot(driver, url, retry_count, viewports)
             return screenshots
             
         except (TimeoutException, WebDriverException) as e:
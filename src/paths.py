@@ -1,12 +1,31 @@
 import os
 from src.url_utils import format_url_to_filename
+from src.storage import AssetStore
 
 # Determine the assets directory path relative to this script's location
 assets_dir = os.path.join(os.path.dirname(__file__), '..', 'assets')
 
+# Bounded storage layer for everything written under assets_dir
+asset_store = AssetStore(assets_dir)
+
+def get_capture_key(url, viewport=None):
+    """
+    Returns the storage key of a capture: the URL's filename without its
+    .png suffix, plus the viewport name for per-viewport captures.
+    """
+    key = format_url_to_filename(url)[:-len('.png')]
+    if viewport:
+        key = f"{key}_{viewport}"
+    return key
+
+def get_tile_filename(capture_key, index):
+    return f"{capture_key}_{index}.png"
+
+def get_tile_path(url, index, viewport=None):
+    return asset_store.path_for(get_tile_filename(get_capture_key(url, viewport), index))
+
 def get_screenshot_path(url):
-    os.makedirs(assets_dir, exist_ok=True)
-    return os.path.join(assets_dir, format_url_to_filename(url))
+    return asset_store.path_for(format_url_to_filename(url))
 
 if __name__ == "__main__":
-    print(assets_dir) 
\ No newline at end of file
+    print(assets_dir) 
@@ -0,0 +1,566 @@
+import os
+import io
+import re
+import time
+import fcntl
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('storage')
+
+# Constants (overridable through the environment, 0 disables the limit)
+MAX_ASSETS_BYTES = int(os.environ.get('ASSETS_MAX_BYTES', 1024 * 1024 * 1024))
+CAPTURE_TTL = int(os.environ.get('ASSETS_TTL', 7 * 24 * 3600))
+JANITOR_INTERVAL = int(os.environ.get('ASSETS_JANITOR_INTERVAL', 300))
+PACK_AFTER = int(os.environ.get('ASSETS_PACK_AFTER', 0))
+ARCHIVE_MAX_BYTES = int(os.environ.get('ASSETS_ARCHIVE_MAX_BYTES', 256 * 1024 * 1024))
+ARCHIVE_DEAD_RATIO = 0.5
+ACCESS_RESOLUTION = 60
+# Reservations older than this belong to a capture that died, and untracked
+# files younger than this may still be being written
+PENDING_TIMEOUT = 3600
+INDEX_TIMEOUT = 30
+
+INDEX_FILENAME = '.index.db'
+JANITOR_LOCK_FILENAME = '.janitor.lock'
+ARCHIVE_DIRNAME = 'archives'
+TILE_PATTERN = re.compile(r'^(?P<key>.+?)(?:_(?P<index>\d+))?\.png$')
+
+INDEX_SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS captures (
+    key TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    ttl INTEGER
+);
+CREATE INDEX IF NOT EXISTS captures_accessed ON captures (accessed);
+CREATE TABLE IF NOT EXISTS tiles (
+    name TEXT PRIMARY KEY,
+    capture_key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    archive TEXT,
+    archive_offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS tiles_capture ON tiles (capture_key);
+CREATE INDEX IF NOT EXISTS tiles_archive ON tiles (archive);
+CREATE TABLE IF NOT EXISTS pending (
+    key TEXT PRIMARY KEY,
+    started REAL NOT NULL
+);
+"""
+
+
+def capture_key_for(filename):
+    """
+    Returns the capture key a tile filename belongs to.
+
+    Args:
+        filename (str): Tile filename such as ``example.com_0.png``
+
+    Returns:
+        str: The capture key (``example.com``), or None if not a PNG tile
+    """
+    match = TILE_PATTERN.match(filename)
+    if not match:
+        return None
+    return match.group('key')
+
+
+def _tile_sort_key(filename):
+    match = TILE_PATTERN.match(filename)
+    index = match.group('index') if match else None
+    return (int(index) if index is not None else -1, filename)
+
+
+class AssetStore:
+    """
+    Bounded storage for captured screenshots.
+
+    Captures (all tiles sharing a capture key) are kept as loose PNG files in
+    the assets directory until they go cold, at which point they can be packed
+    into append-only archive files. A SQLite index records per-capture metadata
+    and the offset of every packed tile, so packed tiles stay servable.
+    The janitor expires captures past their TTL and evicts the least recently
+    accessed captures while the store is over its size cap.
+
+    Tiles are registered only by record_capture. A capture in progress holds a
+    reservation (see reserve) so the janitor leaves its key alone, and the
+    directory is only scanned by the janitor, to adopt or drop stray files.
+    """
+
+    def __init__(self, root, max_bytes=MAX_ASSETS_BYTES, ttl=CAPTURE_TTL,
+                 pack_after=PACK_AFTER, archive_max_bytes=ARCHIVE_MAX_BYTES):
+        self.root = root
+        self.archive_dir = os.path.join(root, ARCHIVE_DIRNAME)
+        self.index_path = os.path.join(root, INDEX_FILENAME)
+        self.janitor_lock_path = os.path.join(root, JANITOR_LOCK_FILENAME)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.pack_after = pack_after
+        self.archive_max_bytes = archive_max_bytes
+        self._schema_ready = False
+        self._janitor = None
+        self._janitor_guard = threading.Lock()
+        self._stop = threading.Event()
+
+    # Index access
+
+    @contextmanager
+    def _connect(self):
+        """Opens a connection to the index, creating the schema on first use."""
+        os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(self.index_path, timeout=INDEX_TIMEOUT, isolation_level=None)
+        try:
+            if not self._schema_ready:
+                conn.executescript(INDEX_SCHEMA)
+                self._schema_ready = True
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _write(self, conn):
+        """Runs a write transaction, taking the index write lock up front."""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    # Public API
+
+    def path_for(self, filename):
+        """Returns the path a new loose tile should be written to."""
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, filename)
+
+    def reserve(self, keys):
+        """
+        Marks captures as in progress so the janitor does not expire, evict or
+        pack them while their tiles are being written.
+
+        Args:
+            keys (list): Capture keys about to be (re)written
+        """
+        now = time.time()
+        with self._connect() as conn, self._write(conn):
+            conn.executemany("INSERT OR REPLACE INTO pending (key, started) VALUES (?, ?)",
+                             [(key, now) for key in keys])
+
+    def release(self, keys):
+        """Drops reservations taken with reserve."""
+        with self._connect() as conn, self._write(conn):
+            conn.executemany("DELETE FROM pending WHERE key = ?", [(key,) for key in keys])
+
+    def record_capture(self, key, paths, ttl=None):
+        """
+        Registers a freshly written capture, replacing any previous one, and
+        releases its reservation.
+
+        The recorded capture itself is never evicted to make room, even when it
+        alone exceeds the size cap.
+
+        Args:
+            key (str): The capture key (tile filename without suffix)
+            paths (list): Paths of the tiles written for this capture
+            ttl (int): Optional per-capture TTL in seconds, overrides the default
+        """
+        tiles = []
+        for path in paths:
+            try:
+                tiles.append((os.path.basename(path), key, os.path.getsize(path)))
+            except OSError:
+                logger.warning(f"Captured tile missing on disk: {path}")
+        names = {name for name, _, _ in tiles}
+
+        now = time.time()
+        with self._connect() as conn, self._write(conn):
+            # Drop stale tiles left over from an earlier, longer capture
+            previous = conn.execute(
+                "SELECT name FROM tiles WHERE capture_key = ? AND archive IS NULL", (key,)
+            ).fetchall()
+            for (name,) in previous:
+                if name not in names:
+                    self._remove_loose(name)
+
+            conn.execute("DELETE FROM tiles WHERE capture_key = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO captures (key, created, accessed, ttl) VALUES (?, ?, ?, ?)",
+                         (key, now, now, ttl))
+            conn.executemany("INSERT OR REPLACE INTO tiles (name, capture_key, size) VALUES (?, ?, ?)", tiles)
+            conn.execute("DELETE FROM pending WHERE key = ?", (key,))
+            self._enforce_size_cap(conn, keep=key)
+
+    def list_assets(self):
+        """Returns the sorted filenames of every stored tile."""
+        with self._connect() as conn:
+            return [name for (name,) in conn.execute("SELECT name FROM tiles ORDER BY name")]
+
+    def find_capture(self, key):
+        """Returns the tile filenames of a capture in tile order."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT name FROM tiles WHERE capture_key = ?", (key,)).fetchall()
+        return sorted((name for (name,) in rows), key=_tile_sort_key)
+
+    def open_asset(self, filename):
+        """
+        Opens a stored tile for reading and marks its capture as accessed.
+
+        Args:
+            filename (str): The tile filename
+
+        Returns:
+            file-like: A binary file object, or None if the tile is unknown
+        """
+        with self._connect() as conn:
+            # A second attempt covers an archive compacted away mid-read
+            for attempt in range(2):
+                row = conn.execute(
+                    "SELECT t.capture_key, t.size, t.archive, t.archive_offset, c.accessed "
+                    "FROM tiles t JOIN captures c ON c.key = t.capture_key WHERE t.name = ?",
+                    (filename,)
+                ).fetchone()
+                if row is None:
+                    return None
+                key, size, archive, offset, accessed = row
+                try:
+                    if archive is None:
+                        asset = open(os.path.join(self.root, filename), 'rb')
+                    else:
+                        with open(os.path.join(self.archive_dir, archive), 'rb') as f:
+                            f.seek(offset)
+                            asset = io.BytesIO(f.read(size))
+                    break
+                except FileNotFoundError:
+                    if attempt:
+                        logger.warning(f"Indexed tile missing on disk: {filename}")
+                        return None
+
+            # Persist access times at a coarse resolution to keep reads cheap
+            now = time.time()
+            if now - accessed >= ACCESS_RESOLUTION:
+                with self._write(conn):
+                    conn.execute("UPDATE captures SET accessed = ? WHERE key = ? AND accessed < ?",
+                                 (now, key, now))
+        return asset
+
+    def total_bytes(self):
+        """Returns the bytes used on disk by loose tiles and archive files."""
+        with self._connect() as conn:
+            return self._disk_bytes(conn)
+
+    # Janitor
+
+    def run_janitor(self):
+        """
+        Runs one janitor pass: adopt stray files, expire, pack, evict and compact.
+        Passes from several processes never overlap; a busy pass is skipped.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.janitor_lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info("Another janitor pass is running, skipping")
+                return
+            try:
+                with self._connect() as conn:
+                    self._janitor_pass(conn)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def start_janitor(self, interval=JANITOR_INTERVAL):
+        """Starts the background janitor thread if it is not already running."""
+        with self._janitor_guard:
+            if self._janitor is not None and self._janitor.is_alive():
+                return
+            self._stop.clear()
+            self._janitor = threading.Thread(target=self._janitor_loop, args=(interval,),
+                                             name='asset-janitor', daemon=True)
+            self._janitor.start()
+        logger.info(f"Asset janitor started (interval {interval}s)")
+
+    def stop_janitor(self):
+        """Signals the background janitor thread to stop."""
+        self._stop.set()
+
+    def _janitor_loop(self, interval):
+        # The first pass runs at startup and reconciles the index with the disk
+        while True:
+            try:
+                self.run_janitor()
+            except Exception as e:
+                logger.error(f"Asset janitor pass failed: {str(e)}")
+            if self._stop.wait(interval):
+                return
+
+    def _janitor_pass(self, conn):
+        now = time.time()
+        with self._write(conn):
+            conn.execute("DELETE FROM pending WHERE started < ?", (now - PENDING_TIMEOUT,))
+            self._scan(conn, now)
+
+            expired = []
+            for key, created, ttl in conn.execute(
+                "SELECT key, created, ttl FROM captures WHERE key NOT IN (SELECT key FROM pending)"
+            ).fetchall():
+                ttl = ttl or self.ttl
+                if ttl and now - created > ttl:
+                    expired.append(key)
+            self._evict(conn, expired)
+            if expired:
+                logger.info(f"Expired {len(expired)} captures past their TTL")
+
+        if self.pack_after:
+            self._pack_cold(conn, now)
+
+        with self._write(conn):
+            self._enforce_size_cap(conn)
+
+        self._compact_archives(conn)
+
+    # Internals (callers hold the index write lock unless noted)
+
+    def _scan(self, conn, now):
+        """
+        Reconciles the index with loose files on disk. Tracked tiles that went
+        missing are dropped. Untracked files old enough not to be in progress
+        become new captures when their key is unknown, or are removed as
+        leftovers of an interrupted re-capture; they never inherit the
+        timestamps of an existing capture.
+        """
+        tracked = dict(conn.execute("SELECT name, archive FROM tiles").fetchall())
+        pending = {key for (key,) in conn.execute("SELECT key FROM pending")}
+        existing = {key for (key,) in conn.execute("SELECT key FROM captures")}
+
+        seen = set()
+        adopted = {}
+        strays = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            key = capture_key_for(entry.name)
+            if key is None:
+                continue
+            seen.add(entry.name)
+            if entry.name in tracked or key in pending:
+                continue
+            st = entry.stat()
+            if now - st.st_mtime < PENDING_TIMEOUT:
+                continue
+            if key in existing:
+                self._remove_loose(entry.name)
+                strays += 1
+                continue
+            capture = adopted.setdefault(key, {'created': st.st_mtime, 'tiles': []})
+            capture['created'] = max(capture['created'], st.st_mtime)
+            capture['tiles'].append((entry.name, key, st.st_size))
+
+        for key, capture in adopted.items():
+            conn.execute("INSERT INTO captures (key, created, accessed, ttl) VALUES (?, ?, ?, NULL)",
+                         (key, capture['created'], capture['created']))
+            conn.executemany("INSERT INTO tiles (name, capture_key, size) VALUES (?, ?, ?)", capture['tiles'])
+
+        missing = [(name,) for name, archive in tracked.items()
+                   if archive is None and name not in seen and capture_key_for(name) not in pending]
+        conn.executemany("DELETE FROM tiles WHERE name = ?", missing)
+        conn.execute("DELETE FROM captures WHERE key NOT IN (SELECT capture_key FROM tiles) "
+                     "AND key NOT IN (SELECT key FROM pending)")
+
+        if adopted or strays or missing:
+            logger.info(f"Scan adopted {len(adopted)} captures, removed {strays} stray tiles, "
+                        f"dropped {len(missing)} missing tiles")
+
+    def _remove_loose(self, name):
+        try:
+            os.remove(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove {name}: {str(e)}")
+
+    def _evict(self, conn, keys):
+        for key in keys:
+            for (name,) in conn.execute(
+                "SELECT name FROM tiles WHERE capture_key = ? AND archive IS NULL", (key,)
+            ).fetchall():
+                self._remove_loose(name)
+            conn.execute("DELETE FROM tiles WHERE capture_key = ?", (key,))
+            conn.execute("DELETE FROM captures WHERE key = ?", (key,))
+            logger.debug(f"Evicted capture {key}")
+
+    def _archive_files(self):
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return sorted(name for name in os.listdir(self.archive_dir) if name.endswith('.pack'))
+
+    def _disk_bytes(self, conn):
+        """Returns loose plus archive bytes (no lock needed)."""
+        loose = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles WHERE archive IS NULL").fetchone()[0]
+        packed = sum(os.path.getsize(os.path.join(self.archive_dir, name))
+                     for name in self._archive_files())
+        return loose + packed
+
+    def _enforce_size_cap(self, conn, keep=None):
+        """
+        Evicts least recently accessed captures until live data fits the cap.
+        Reserved captures and the one named by keep are never evicted.
+
+        Args:
+            keep (str): Capture key that must not be evicted
+        """
+        if not self.max_bytes:
+            return
+        live = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+        if live <= self.max_bytes:
+            return
+        candidates = conn.execute(
+            "SELECT c.key, SUM(t.size) FROM captures c JOIN tiles t ON t.capture_key = c.key "
+            "WHERE c.key NOT IN (SELECT key FROM pending) AND c.key IS NOT ? "
+            "GROUP BY c.key ORDER BY c.accessed",
+            (keep,)
+        ).fetchall()
+        evicted = []
+        for key, size in candidates:
+            if live <= self.max_bytes:
+                break
+            live -= size
+            evicted.append(key)
+        self._evict(conn, evicted)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} least recently accessed captures to stay under {self.max_bytes} bytes")
+        if live > self.max_bytes and keep is not None:
+            logger.warning(f"Capture {keep} alone exceeds the {self.max_bytes} byte size cap, keeping it")
+
+    def _current_archive(self, incoming):
+        """Returns the archive to append to, rolling over when it would grow too large."""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archives = self._archive_files()
+        if archives:
+            latest = archives[-1]
+            size = os.path.getsize(os.path.join(self.archive_dir, latest))
+            if not self.archive_max_bytes or size + incoming <= self.archive_max_bytes:
+                return latest
+        return self._next_archive_name()
+
+    def _next_archive_name(self):
+        archives = self._archive_files()
+        number = int(archives[-1].split('.')[0]) + 1 if archives else 0
+        return f"{number:06d}.pack"
+
+    def _append(self, archive, blobs):
+        """Appends (name, data) blobs to an archive, returning their offsets."""
+        offsets = {}
+        with open(os.path.join(self.archive_dir, archive), 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            for name, data in blobs:
+                offsets[name] = f.tell()
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return offsets
+
+    def _pack_cold(self, conn, now):
+        """
+        Copies cold loose captures into archives, then points their tiles at
+        the archives and removes the loose copies in a single transaction.
+        Called without the write lock; only one janitor pass appends at a time.
+        """
+        rows = conn.execute(
+            "SELECT t.capture_key, t.name FROM tiles t JOIN captures c ON c.key = t.capture_key "
+            "WHERE t.archive IS NULL AND c.accessed < ? AND c.key NOT IN (SELECT key FROM pending)",
+            (now - self.pack_after,)
+        ).fetchall()
+        captures = {}
+        for key, name in rows:
+            captures.setdefault(key, []).append(name)
+
+        updates = []
+        for key, names in captures.items():
+            blobs = []
+            try:
+                for name in sorted(names, key=_tile_sort_key):
+                    with open(os.path.join(self.root, name), 'rb') as f:
+                        blobs.append((name, f.read()))
+            except FileNotFoundError:
+                continue
+            archive = self._current_archive(sum(len(data) for _, data in blobs))
+            offsets = self._append(archive, blobs)
+            updates.extend((key, name, archive, offsets[name], len(data)) for name, data in blobs)
+        if not updates:
+            return
+
+        packed = set()
+        with self._write(conn):
+            # Captures reserved since we read them are being rewritten, leave them loose
+            pending = {key for (key,) in conn.execute("SELECT key FROM pending")}
+            for key, name, archive, offset, size in updates:
+                if key in pending:
+                    continue
+                cursor = conn.execute(
+                    "UPDATE tiles SET archive = ?, archive_offset = ?, size = ? "
+                    "WHERE name = ? AND capture_key = ? AND archive IS NULL",
+                    (archive, offset, size, name, key)
+                )
+                if cursor.rowcount:
+                    self._remove_loose(name)
+                    packed.add(key)
+        if packed:
+            logger.info(f"Packed {len(packed)} cold captures into archives")
+
+    def _compact_archives(self, conn):
+        """
+        Removes archives without live tiles and rewrites those dominated by
+        dead (evicted) tiles, or holding any dead bytes while over the size cap.
+        Called without the write lock; only one janitor pass compacts at a time.
+        """
+        force = bool(self.max_bytes) and self._disk_bytes(conn) > self.max_bytes
+        live = {archive: size for archive, size in conn.execute(
+            "SELECT archive, SUM(size) FROM tiles WHERE archive IS NOT NULL GROUP BY archive"
+        )}
+
+        updates = []
+        retired = []
+        for archive in self._archive_files():
+            path = os.path.join(self.archive_dir, archive)
+            size = os.path.getsize(path)
+            if archive not in live:
+                retired.append(archive)
+                continue
+            dead = size - live[archive]
+            if not dead or (not force and dead < size * ARCHIVE_DEAD_RATIO):
+                continue
+
+            tiles = conn.execute(
+                "SELECT name, archive_offset, size FROM tiles WHERE archive = ? ORDER BY archive_offset",
+                (archive,)
+            ).fetchall()
+            blobs = []
+            with open(path, 'rb') as f:
+                for name, offset, tile_size in tiles:
+                    f.seek(offset)
+                    blobs.append((name, f.read(tile_size)))
+            target = self._next_archive_name()
+            offsets = self._append(target, blobs)
+            updates.extend((target, offsets[name], name, archive) for name, _ in blobs)
+            retired.append(archive)
+            logger.info(f"Compacted archive {archive} into {target}, reclaimed {dead} bytes")
+
+        if updates:
+            # Point the index at the new archives before dropping the old ones
+            with self._write(conn):
+                conn.executemany("UPDATE tiles SET archive = ?, archive_offset = ? WHERE name = ? AND archive = ?",
+                                 updates)
+        for archive in retired:
+            os.remove(os.path.join(self.archive_dir, archive))
+            logger.info(f"Removed archive {archive}")
+
+
+if __name__ == "__main__":
+    from src.paths import asset_store
+    asset_store.run_janitor()
+    print(f"Assets on disk: {asset_store.total_bytes()} bytes")
@@ -1,94 +1,202 @@
-from urllib.parse import urlparse, unquote
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, unquote
+from functools import lru_cache
+import hashlib
 import re
 import logging
 
 logger = logging.getLogger('url_utils')
 
+# Constants
+KEY_LENGTH = 16
+MAX_FILENAME_PATH = 100
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Precompiled patterns, these run on every request and listing
+SCHEME_PATTERN = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+# Already-canonical URLs (lowercase host, no port, escapes, query or fragment) skip parsing
+CANONICAL_PATTERN = re.compile(r'^https?://[a-z0-9.-]*[a-z0-9](?:/[A-Za-z0-9._~/-]*)?$')
+TRACKING_PARAM_PATTERN = re.compile(
+    r'^(?:utm_\w+|fbclid|gclid|dclid|gbraid|wbraid|msclkid|yclid|igshid|mc_cid|mc_eid|_ga|_gl|_hsenc|_hsmi|mkt_tok)$',
+    re.IGNORECASE
+)
+PERCENT_ESCAPE_PATTERN = re.compile(r'%([0-9A-Fa-f]{2})')
+UNRESERVED_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+# Hash-bang and hash-route fragments address distinct client-side pages
+ROUTE_FRAGMENT_PATTERN = re.compile(r'^!?/')
+UNSAFE_CHARS_PATTERN = re.compile(r'[^a-zA-Z0-9.-]')
+REPEATED_UNDERSCORE_PATTERN = re.compile(r'_+')
+
+def _normalize_escape(match):
+    char = chr(int(match.group(1), 16))
+    return char if char in UNRESERVED_CHARS else f"%{match.group(1).upper()}"
+
+def normalize_percent_escapes(value):
+    """
+    Decodes percent-escapes of unreserved characters and uppercases the rest,
+    so equivalent spellings of a path (``/%7Efoo`` and ``/~foo``) compare equal.
+
+    Args:
+        value (str): A URL path or fragment
+
+    Returns:
+        str: The normalized value
+    """
+    if '%' not in value:
+        return value
+    return PERCENT_ESCAPE_PATTERN.sub(_normalize_escape, value)
+
 def validate_url(url):
     """
     Validates and normalizes a URL.
-    
+
     Args:
         url (str): The URL to validate
-        
+
     Returns:
         str: The normalized URL
-        
+
     Raises:
         ValueError: If URL is invalid
     """
     if not url or not isinstance(url, str):
         raise ValueError("URL must be a non-empty string")
-        
+
     # Trim whitespace
     url = url.strip()
-    
+
     # Add protocol if missing
-    if not url.startswith(('http://', 'https://')):
+    if not SCHEME_PATTERN.match(url):
         url = f"http://{url}"
-    
+
     try:
-        parsed = urlparse(url)
-        if not parsed.netloc:
-            raise ValueError(f"Invalid URL format: {url}")
+        parsed = urlsplit(url)
     except Exception as e:
         logger.error(f"URL parse error: {str(e)}")
         raise ValueError(f"Invalid URL: {str(e)}")
-        
+
+    if parsed.scheme.lower() not in DEFAULT_PORTS:
+        raise ValueError(f"Unsupported URL scheme: {parsed.scheme}")
+    if not parsed.hostname:
+        raise ValueError(f"Invalid URL format: {url}")
+
     return url
 
+@lru_cache(maxsize=4096)
+def canonicalize_url(url):
+    """
+    Returns the canonical form of a URL used for storage, lookup and deduplication.
+
+    The scheme and host are lowercased, default ports and tracking parameters
+    are removed, remaining query parameters are sorted, percent-escapes are
+    normalized, and the fragment is kept only when it is a client-side route
+    (``#/...`` or ``#!/...``).
+
+    Args:
+        url (str): The URL to canonicalize
+
+    Returns:
+        str: The canonical URL
+
+    Raises:
+        ValueError: If URL is invalid
+    """
+    url = validate_url(url)
+    if CANONICAL_PATTERN.match(url):
+        return url if url.count('/') > 2 else f"{url}/"
+
+    parsed = urlsplit(url)
+    scheme = parsed.scheme.lower()
+
+    host = parsed.hostname.rstrip('.')
+    if ':' in host:
+        # IPv6 literals keep their brackets
+        host = f"[{host}]"
+    try:
+        port = parsed.port
+    except ValueError as e:
+        raise ValueError(f"Invalid URL port: {str(e)}")
+    if port and port != DEFAULT_PORTS[scheme]:
+        host = f"{host}:{port}"
+
+    path = normalize_percent_escapes(parsed.path) or '/'
+
+    params = [
+        (name, value) for name, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not TRACKING_PARAM_PATTERN.match(name)
+    ]
+    query = urlencode(sorted(params))
+
+    fragment = normalize_percent_escapes(parsed.fragment)
+    if not ROUTE_FRAGMENT_PATTERN.match(fragment):
+        fragment = ''
+
+    return urlunsplit((scheme, host, path, query, fragment))
+
+@lru_cache(maxsize=4096)
+def url_key(url):
+    """
+    Returns a stable short hash key for a URL.
+
+    URLs with the same canonical form share a key, so the key is safe to use
+    for storage, lookup and deduplication.
+
+    Args:
+        url (str): The URL to hash
+
+    Returns:
+        str: A hexadecimal key of KEY_LENGTH characters
+    """
+    canonical = canonicalize_url(url)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=KEY_LENGTH // 2).hexdigest()
+
 def format_url_to_filename(url):
     """
     Formats a URL into a safe filename.
-    
+
+    The readable domain/path prefix is followed by the URL key, so URLs that
+    differ only in their query string or beyond the truncated path never
+    share a filename.
+
     Args:
         url (str): The URL to format
-        
+
     Returns:
         str: A filename-safe representation of the URL
     """
     try:
-        # Validate and normalize URL
-        url = validate_url(url)
-        
-        # Parse URL components
-        parsed_url = urlparse(url)
-        
+        key = url_key(url)
+        parsed_url = urlsplit(canonicalize_url(url))
+
         # Extract domain without www.
-        domain = parsed_url.netloc
+        domain = parsed_url.hostname
         if domain.startswith('www.'):
             domain = domain[4:]
-            
+
         # Clean up domain (replace invalid characters)
-        domain = re.sub(r'[^a-zA-Z0-9.-]', '_', domain)
-        
-        # Extract and clean path
-        path = parsed_url.path.strip('/')
-        
-        # URL decode the path (handle special characters)
-        path = unquote(path)
-        
-        # Replace path separators and invalid characters
-        path = re.sub(r'[^a-zA-Z0-9.-]', '_', path)
-        
-        # Truncate if too long (preventing extremely long filenames)
-        if len(path) > 100:
-            path = path[:100]
-            
+        domain = UNSAFE_CHARS_PATTERN.sub('_', domain)
+
+        # Extract and clean path, URL decoding special characters
+        path = unquote(parsed_url.path.strip('/'))
+        path = UNSAFE_CHARS_PATTERN.sub('_', path)
+
+        # Truncate if too long (the key keeps truncated names unique)
+        if len(path) > MAX_FILENAME_PATH:
+            path = path[:MAX_FILENAME_PATH]
+
         # Build filename
         if path:
-            filename = f"{domain}_{path}.png"
+            filename = f"{domain}_{path}_{key}.png"
         else:
-            filename = f"{domain}.png"
-            
+            filename = f"{domain}_{key}.png"
+
         # Ensure no double underscores
-        filename = re.sub(r'_+', '_', filename)
-        
+        filename = REPEATED_UNDERSCORE_PATTERN.sub('_', filename)
+
         logger.debug(f"Formatted URL {url} to filename {filename}")
         return filename
-        
+
     except Exception as e:
         logger.error(f"Error formatting URL to filename: {str(e)}")
         # Provide a fallback for error cases
-        safe_url = re.sub(r'[^a-zA-Z0-9.-]', '_', url)
-        return f"error_{safe_url[:50]}.png"
\ No newline at end of file
+        safe_url = UNSAFE_CHARS_PATTERN.sub('_', str(url))
+        return f"error_{safe_url[:50]}.png"